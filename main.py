@@ -3,9 +3,92 @@ import json
 import argparse
 from urllib.parse import parse_qs, urlparse, quote
 import time
+import os
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# --- HTTP-SITZUNG ---
+
+# Eine gemeinsame Sitzung für alle Anfragen: Die TLS-Verbindung zu bahn.de wird
+# wiederverwendet, und kurzzeitige 502/503/504-Fehler werden automatisch wiederholt.
+# Die Such-Endpunkte sind lesende POST-Anfragen und dürfen daher ebenfalls wiederholt werden.
+_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET", "POST"])
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=20, max_retries=_RETRY))
+# Komprimierte Antworten anfordern; 'br'/'zstd' werden nur angeboten, wenn der Decoder installiert ist.
+_SESSION.headers.update({"User-Agent": "Mozilla/5.0", "Accept": "application/json", "Accept-Encoding": DEFAULT_ACCEPT_ENCODING})
+_JSON_HEADERS = {"Content-Type": "application/json; charset=UTF-8"}
+
+# Gemeinsamer Token-Bucket für alle parallel arbeitenden Threads, um bahn.de nicht zu überlasten:
+# Alle REQUEST_DELAY Sekunden kommt ein Token hinzu, nach einer Pause sind bis zu REQUEST_BURST
+# Anfragen sofort möglich.
+REQUEST_DELAY = 0.5
+MAX_PARALLEL_REQUESTS = 4
+REQUEST_BURST = MAX_PARALLEL_REQUESTS
+_tokens = float(REQUEST_BURST)
+_tokens_updated = time.monotonic()
+_request_lock = threading.Lock()
+
+# --- PERSISTENTER CACHE ---
+
+# API-Antworten werden zwischen Programmläufen in einer kleinen SQLite-Datei zwischengespeichert:
+# die unveränderliche Auflösung eines vbid-Kurzlinks lange, Verbindungen mit Live-Preisen nur kurz.
+# Die Versionsnummer im Schlüssel erlaubt es, alte Einträge bei einem Formatwechsel gefahrlos zu ignorieren.
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "better-bahn", "cache.sqlite3")
+CACHE_VERSION = 1
+VBID_CACHE_TTL = 24 * 60 * 60
+PRICE_CACHE_TTL = 10 * 60
+
+def cache_key(prefix, payload):
+    """ Bildet einen kurzen, stabilen Cache-Schlüssel aus einer Anfrage-Payload. """
+    digest = hashlib.blake2b(json.dumps(payload, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return f"{prefix}:{digest}"
+
+def cache_get(key):
+    """ Liefert einen noch gültigen Eintrag aus dem Cache oder None. """
+    try:
+        with closing(sqlite3.connect(CACHE_PATH)) as db:
+            row = db.execute("SELECT value FROM cache WHERE key = ? AND expires > ?",
+                             (f"v{CACHE_VERSION}:{key}", time.time())).fetchone()
+    except sqlite3.Error:
+        return None
+    return json.loads(row[0]) if row else None
+
+def cache_set(key, value, ttl):
+    """ Speichert einen Eintrag für 'ttl' Sekunden im Cache und entfernt abgelaufene Einträge.
+        Fehler beim Schreiben werden ignoriert. """
+    now = time.time()
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        with closing(sqlite3.connect(CACHE_PATH)) as db, db:
+            db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)")
+            db.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+            db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                       (f"v{CACHE_VERSION}:{key}", now + ttl, json.dumps(value)))
+    except (OSError, sqlite3.Error):
+        pass
 
 # --- HILFSFUNKTIONEN ---
 
+def wait_for_request_slot():
+    """ Entnimmt ein Token aus dem Bucket und wartet nur, falls gerade keins verfügbar ist. """
+    global _tokens, _tokens_updated
+    with _request_lock:
+        now = time.monotonic()
+        _tokens = min(REQUEST_BURST, _tokens + (now - _tokens_updated) / REQUEST_DELAY)
+        _tokens_updated = now
+        # Ein negativer Stand reserviert das Token für einen wartenden Thread.
+        _tokens -= 1
+        wait = -_tokens * REQUEST_DELAY
+    if wait > 0:
+        time.sleep(wait)
+
 def create_traveller_payload(age, bahncard_option):
     """ Erstellt das 'reisende' JSON-Objekt basierend auf der ausgewählten BahnCard. """
     ermaessigung = {"art": "KEINE_ERMAESSIGUNG", "klasse": "KLASSENLOS"}
@@ -22,22 +105,29 @@ def resolve_vbid_to_connection(vbid, traveller_payload, deutschland_ticket):
     """ Löst einen kurzen vbid-Link auf, um die vollständigen Verbindungsdetails zu erhalten. """
     print(f"Löse vbid '{vbid}' auf...")
     try:
-        vbid_url = f"https://www.bahn.de/web/api/angebote/verbindung/{vbid}"
-        headers = {"User-Agent": "Mozilla/5.0", "Accept": "application/json"}
-        response = requests.get(vbid_url, headers=headers)
-        response.raise_for_status()
-        vbid_data = response.json()
-        recon_string = vbid_data.get("hinfahrtRecon")
+        recon_string = cache_get(f"vbid:{vbid}")
         if not recon_string:
-            print("Fehler: Konnte keinen 'hinfahrtRecon' aus der vbid-Antwort extrahieren.")
-            return None
+            vbid_url = f"https://www.bahn.de/web/api/angebote/verbindung/{vbid}"
+            response = _SESSION.get(vbid_url)
+            response.raise_for_status()
+            vbid_data = response.json()
+            recon_string = vbid_data.get("hinfahrtRecon")
+            if not recon_string:
+                print("Fehler: Konnte keinen 'hinfahrtRecon' aus der vbid-Antwort extrahieren.")
+                return None
+            cache_set(f"vbid:{vbid}", recon_string, VBID_CACHE_TTL)
         recon_url = "https://www.bahn.de/web/api/angebote/recon"
         payload = {"klasse": "KLASSE_2", "reisende": traveller_payload, "ctxRecon": recon_string, "deutschlandTicketVorhanden": deutschland_ticket}
-        headers["Content-Type"] = "application/json; charset=UTF-8"
+        key = cache_key("recon", payload)
+        connection_data = cache_get(key)
+        if connection_data is not None:
+            return connection_data
         print("Rufe vollständige Verbindungsdetails mit dem Recon-String ab...")
-        response = requests.post(recon_url, json=payload, headers=headers)
+        response = _SESSION.post(recon_url, json=payload, headers=_JSON_HEADERS)
         response.raise_for_status()
-        return response.json()
+        connection_data = response.json()
+        cache_set(key, connection_data, PRICE_CACHE_TTL)
+        return connection_data
     except requests.RequestException as e:
         print(f"Fehler beim Auflösen der vbid '{vbid}': {e}")
         return None
@@ -51,21 +141,29 @@ def get_connection_details(from_station_id, to_station_id, date, departure_time,
         "produktgattungen": ["ICE", "EC_IC", "IR", "REGIONAL", "SBAHN", "BUS", "SCHIFF", "UBAHN", "TRAM", "ANRUFPFLICHTIG"],
         "reisende": traveller_payload, "schnelleVerbindungen": True, "deutschlandTicketVorhanden": deutschland_ticket
     }
-    headers = {"User-Agent": "Mozilla/5.0", "Accept": "application/json", "Content-Type": "application/json; charset=UTF-8"}
+    key = cache_key("fahrplan", payload)
+    connections = cache_get(key)
+    if connections is not None:
+        return connections
+    # Nur echte Netzwerkanfragen verbrauchen ein Token des Rate-Limits.
+    wait_for_request_slot()
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = _SESSION.post(url, json=payload, headers=_JSON_HEADERS)
         response.raise_for_status()
-        return response.json()
+        connections = response.json()
     except requests.RequestException:
         return None
+    cache_set(key, connections, PRICE_CACHE_TTL)
+    return connections
 
 def get_segment_data(from_stop, to_stop, date, traveller_payload, deutschland_ticket):
-    """ Fragt alle notwendigen Daten für ein Segment an und prüft auf Gültigkeit des Deutschland-Tickets. """
-    time.sleep(0.5)
+    """ Fragt alle notwendigen Daten für ein Segment an und prüft auf Gültigkeit des Deutschland-Tickets.
+        Gibt (Segmentdaten oder None, Statusmeldung) zurück, damit parallele Abfragen geordnet ausgegeben werden. """
     departure_time_str = from_stop['departure_time']
-    if not departure_time_str: return None
+    if not departure_time_str: return None, ""
     
     connections = get_connection_details(from_stop['id'], to_stop['id'], date, departure_time_str, traveller_payload, deutschland_ticket)
+    status = ""
     if connections and connections.get('verbindungen'):
         first_connection = connections['verbindungen'][0]
         price = first_connection.get('angebotsPreis', {}).get('betrag')
@@ -80,13 +178,12 @@ def get_segment_data(from_stop, to_stop, date, traveller_payload, deutschland_ti
                     is_covered_by_d_ticket = True; break
         
         if is_covered_by_d_ticket:
-            print(f" -> Deutschland-Ticket gültig! Preis wird auf 0.00 € gesetzt.")
+            status = " -> Deutschland-Ticket gültig! Preis wird auf 0.00 € gesetzt."
             price = 0.0
         elif price is not None:
-            print(f" -> Preis gefunden: {price:.2f} €")
+            status = f" -> Preis gefunden: {price:.2f} €"
         else:
-            print(" -> Kein Preis für dieses Segment verfügbar.")
-            return None
+            return None, " -> Kein Preis für dieses Segment verfügbar."
 
         if price is not None and departure_iso:
             return {
@@ -94,10 +191,15 @@ def get_segment_data(from_stop, to_stop, date, traveller_payload, deutschland_ti
                 "start_name": from_stop['name'], "end_name": to_stop['name'],
                 "start_id": from_stop['id'], "end_id": to_stop['id'],
                 "departure_iso": departure_iso
-            }
+            }, status
             
-    print(" -> Keine Verbindungsdaten erhalten.")
-    return None
+    return None, status + " -> Keine Verbindungsdaten erhalten."
+
+# BahnCard-Option -> 'r'-Parameter des Buchungslinks
+_BC_MAP = {
+    'BC25_2': '13:25:KLASSE_2:1', 'BC25_1': '13:25:KLASSE_1:1',
+    'BC50_2': '13:50:KLASSE_2:1', 'BC50_1': '13:50:KLASSE_1:1'
+}
 
 def generate_booking_link(segment, bahncard_option, has_d_ticket):
     """ Erstellt einen stabilen, kontextreichen Buchungslink (Deep Link). """
@@ -113,11 +215,7 @@ def generate_booking_link(segment, bahncard_option, has_d_ticket):
     r_param = ""
 
     if bahncard_option:
-        bc_map = {
-            'BC25_2': '13:25:KLASSE_2:1', 'BC25_1': '13:25:KLASSE_1:1',
-            'BC50_2': '13:50:KLASSE_2:1', 'BC50_1': '13:50:KLASSE_1:1'
-        }
-        r_code = bc_map.get(bahncard_option)
+        r_code = _BC_MAP.get(bahncard_option)
         if r_code:
             r_param = f"&r={quote(r_code)}"
 
@@ -130,26 +228,39 @@ def find_cheapest_split(stops, date, direct_price, traveller_payload, args):
     n = len(stops)
     segments_data = {}
     print("\n--- Preise und Daten für alle möglichen Teilstrecken werden abgerufen ---")
-    
-    for i in range(n):
-        for j in range(i + 1, n):
-            from_stop, to_stop = stops[i], stops[j]
-            print(f"Frage Daten an für: {from_stop['name']} -> {to_stop['name']}...", end='', flush=True)
-            data = get_segment_data(from_stop, to_stop, date, traveller_payload, args.deutschland_ticket)
-            if data:
-                segments_data[(i, j)] = data
 
     dp = [float('inf')] * n
     dp[0] = 0
     path_reconstruction = [-1] * n
+    skipped = 0
 
-    for i in range(1, n):
-        for j in range(i):
-            if (j, i) in segments_data:
-                cost = dp[j] + segments_data[(j, i)]['price']
-                if cost < dp[i]:
-                    dp[i] = cost
-                    path_reconstruction[i] = j
+    # Die Teilstrecken werden zeilenweise nach Starthalt abgefragt und sofort in die DP eingerechnet.
+    # Da kein Preis negativ ist, steht dp[i] vor Zeile i fest, und Anfragen, die das Ergebnis
+    # nicht mehr verbessern können, werden übersprungen.
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS) as executor:
+        for i in range(n - 1):
+            if dp[i] >= min(direct_price, dp[-1]):
+                # Jede Kombination über Halt i wäre mindestens so teuer wie die beste bekannte Lösung.
+                skipped += n - 1 - i
+                continue
+            targets = [j for j in range(i + 1, n) if dp[i] < dp[j]]
+            skipped += n - 1 - i - len(targets)
+
+            def fetch(j):
+                return get_segment_data(stops[i], stops[j], date, traveller_payload, args.deutschland_ticket)
+
+            # Die Anfragen laufen parallel, die Ausgabe erfolgt trotzdem in der ursprünglichen Reihenfolge.
+            for j, (data, status) in zip(targets, executor.map(fetch, targets)):
+                print(f"Frage Daten an für: {stops[i]['name']} -> {stops[j]['name']}...{status}")
+                if data:
+                    segments_data[(i, j)] = data
+                    cost = dp[i] + data['price']
+                    if cost < dp[j]:
+                        dp[j] = cost
+                        path_reconstruction[j] = i
+
+    if skipped:
+        print(f"{skipped} Teilstrecken übersprungen, da sie keine günstigere Kombination ergeben können.")
     
     cheapest_split_price = dp[-1]
     
@@ -200,23 +311,21 @@ if __name__ == "__main__":
     
     connection_data, date_part = None, None
     
-    url_to_parse = args.url
-    if "/buchung/start" in url_to_parse:
-        parsed_url = urlparse(url_to_parse)
-        query_params = parse_qs(parsed_url.query)
-        if 'vbid' in query_params:
-            url_to_parse = f"https://www.bahn.de?vbid={query_params['vbid'][0]}"
-
-    if "vbid=" in url_to_parse:
+    # Der URL wird nur einmal zerlegt; kurze Links tragen die vbid im Query-String, lange Links
+    # die Verbindungsparameter im Fragment.
+    parsed_url = urlparse(args.url)
+    query_params = parse_qs(parsed_url.query)
+
+    if 'vbid' in query_params:
         print("--- Kurzer Link (vbid) erkannt ---")
-        vbid = parse_qs(urlparse(url_to_parse).query)['vbid'][0]
+        vbid = query_params['vbid'][0]
         connection_data = resolve_vbid_to_connection(vbid, traveller_payload, args.deutschland_ticket)
         if connection_data:
             first_stop_departure = connection_data['verbindungen'][0]['verbindungsAbschnitte'][0]['halte'][0]['abfahrtsZeitpunkt']
             date_part = first_stop_departure.split('T')[0]
     else:
         print("--- Langer Link erkannt ---")
-        params = parse_qs(urlparse(url_to_parse).fragment)
+        params = parse_qs(parsed_url.fragment)
         if not all(k in params for k in ['soid', 'zoid', 'hd']):
             print("Fehler: Der lange URL ist unvollständig."); exit()
         from_station_id, to_station_id, datetime_str = params['soid'][0], params['zoid'][0], params['hd'][0]
@@ -240,11 +349,13 @@ if __name__ == "__main__":
     print(f"Direktpreis gefunden: {direct_price:.2f} €")
 
     all_stops = []
+    seen_stop_ids = set()
     print("\n--- Extrahiere alle Haltestellen der Verbindung ---")
     for section in first_connection['verbindungsAbschnitte']:
         if section['verkehrsmittel']['typ'] != 'WALK':
             for halt in section['halte']:
-                if not any(stop['id'] == halt['id'] for stop in all_stops):
+                if halt['id'] not in seen_stop_ids:
+                    seen_stop_ids.add(halt['id'])
                     all_stops.append({
                         'name': halt['name'], 'id': halt['id'],
                         'departure_time': halt.get('abfahrtsZeitpunkt', '').split('T')[-1] if halt.get('abfahrtsZeitpunkt') else '',